@@ -1,170 +1,300 @@
 import sys
 import argparse
 import logging
-import json
+import logging.handlers
+import atexit
+import time
+import threading
+import queue
+import socket
+import msgspec
+import requests
 import paho.mqtt.client as mqtt
 from influxdb import InfluxDBClient
-from datetime import datetime
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from typing import Any, Dict, List
 
 log = logging.getLogger('WlanThermoGrafanaBridge')
-
-class GlobalScope:
-    influxDbClient = None
-    wlanThermoHostname = None
+_DEBUG = log.isEnabledFor(logging.DEBUG)
+
+FLUSH_BATCH_SIZE = 100
+FLUSH_INTERVAL = 1.0 # seconds
+WRITE_QUEUE_SIZE = 10000
+WRITER_SHUTDOWN_TIMEOUT = 10.0 # seconds
+
+# identifiers (number, name, id) are already stored as measurement or tags, colors are display only and not decoded
+CHANNEL_FIELDS = ('temp', 'min', 'max', 'alarm', 'typ')
+PITMASTER_FIELDS = ('channel', 'pid', 'value', 'set', 'typ')
+
+class DataChannel(msgspec.Struct):
+    number: int
+    name: str
+    temp: Any # kept as sent, so integer temperatures keep their influxdb field type
+    min: Any = None
+    max: Any = None
+    alarm: Any = None
+    typ: Any = None
+
+class DataPitmasterPm(msgspec.Struct):
+    id: int
+    channel: Any = None
+    pid: Any = None
+    value: Any = None
+    set: Any = None
+    typ: Any = None
+
+class DataPitmaster(msgspec.Struct):
+    pm: List[DataPitmasterPm] = []
+
+class DataMessage(msgspec.Struct):
+    system: Dict[str, Any] # stored as is, like the settings system object
+    channel: List[DataChannel] = []
+    pitmaster: DataPitmaster = msgspec.field(default_factory=DataPitmaster)
+
+DATA_MESSAGE_DECODER = msgspec.json.Decoder(DataMessage)
 
 def getTimestampStr(unixTimestamp):
-    timestamp = None
     if unixTimestamp < 631152000: # 01.01.1990 00:00:00
         # internal system time of wlanthermo starts counting from 0 until external time is provided
         # we assume the system up time will never reach 631152000 on its own
         # if internal time is detected we use receive timestamps instead
-        timestamp = datetime.utcnow()
-        log.debug('Wlanthermo running on internal time > using receive timestamps')
-    else:
-        timestamp = datetime.fromtimestamp(unixTimestamp)
-
-    timestampStr = timestamp.astimezone().replace(microsecond=0).isoformat()
-
-    return timestampStr
+        if _DEBUG:
+            log.debug('Wlanthermo running on internal time > using receive timestamps')
+        unixTimestamp = int(time.time())
+
+    return f"{unixTimestamp}000000000" # line protocol timestamps are in nanoseconds
+
+def escapeLineProtocolKey(key):
+    return key.replace("\\", "\\\\").replace(" ", "\\ ").replace(",", "\\,").replace("=", "\\=").replace("\n", "\\n")
+
+def formatLineProtocolValue(value):
+    if isinstance(value, str):
+        return '"{}"'.format(value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    return None # nested objects cannot be stored as field values
+
+def appendLineProtocolPoint(points, measurement, tags, fields, timestamp):
+    escapeKey = escapeLineProtocolKey
+    formatValue = formatLineProtocolValue
+    fieldSet = []
+    appendField = fieldSet.append
+    for fieldKey, fieldValue in fields.items():
+        fieldValue = formatValue(fieldValue)
+        if fieldValue is not None:
+            appendField(f"{escapeKey(fieldKey)}={fieldValue}")
+
+    if not fieldSet:
+        return
+
+    line = escapeKey(measurement)
+    for tagKey, tagValue in tags.items(): # callers pass tags in key order, influxdb expects them sorted
+        if tagValue: # empty tag values are rejected by influxdb
+            line += f",{escapeKey(tagKey)}={escapeKey(tagValue)}"
+
+    points.append(f"{line} {','.join(fieldSet)} {timestamp}")
 
 def createDataSystemPoints(points, timestamp, message):
-    log.debug('Creating data [system] points from json payload')
+    if _DEBUG:
+        log.debug('Creating data [system] points from json payload')
 
-    systemItem = {}
-    systemItem['measurement'] = "System"
-    systemItem['time'] = timestamp
-    systemItem['fields'] = message['system']
-
-    points.append(systemItem)
+    appendLineProtocolPoint(points, "System", {}, message.system, timestamp)
 
 def createDataChannelPoints(points, timestamp, message):
-    log.debug('Creating data [channel] points from json payload')
-
-    for channel in message['channel']:
-        if channel['temp'] < 999: # 999 means channel not active
-            channelItem = {}
-
-            channelTags = {}
-            channelTags['channel'] = "Channel {}".format(channel['number'])
-            channelTags['alias'] = channel['name']
-
-            channelItem['measurement'] = "Temperature"
-            channelItem['time'] = timestamp
-            channelItem['tags'] = channelTags
-            channelItem['fields'] = channel
+    if _DEBUG:
+        log.debug('Creating data [channel] points from json payload')
 
-            points.append(channelItem)
+    appendPoint = appendLineProtocolPoint
+    for channel in message.channel:
+        if channel.temp >= 999: # 999 means channel not active
+            continue
+        tags = {'alias': channel.name, 'channel': f"Channel {channel.number}"}
+        fields = {key: getattr(channel, key) for key in CHANNEL_FIELDS}
+        appendPoint(points, "Temperature", tags, fields, timestamp)
 
 def createDataPitmasterPoints(points, timestamp, message):
-    log.debug('Creating data [pitmaster] points from json payload')
+    if _DEBUG:
+        log.debug('Creating data [pitmaster] points from json payload')
 
-    for pmObject in message['pitmaster']['pm']:
-        pitmasterItem = {}
-        pitmasterItem['measurement'] = "Pitmaster {}".format(pmObject['id'])
-        pitmasterItem['time'] = timestamp
-        pitmasterItem['fields'] = pmObject
-
-        points.append(pitmasterItem)
+    for pmObject in message.pitmaster.pm:
+        fields = {key: getattr(pmObject, key) for key in PITMASTER_FIELDS}
+        appendLineProtocolPoint(points, f"Pitmaster {pmObject.id}", {}, fields, timestamp)
 
 def createSettingsSystemPoints(points, timestamp, message):
-    log.debug('Creating settings [system] points from json payload')
-
-    systemItem = {}
-    systemItem['measurement'] = "System settings"
-    systemItem['time'] = timestamp
-    systemItem['fields'] = message['system']
+    if _DEBUG:
+        log.debug('Creating settings [system] points from json payload')
 
-    points.append(systemItem)
+    appendLineProtocolPoint(points, "System settings", {}, message['system'], timestamp)
 
 def addPointsToDatabase(influxDbClient, points):
-    if len(points) > 0:
-        try:
-            influxDbClient.write_points(points=points, database='wlanthermo')
-            log.info('InfluxDB datapoints inserted')
-        except Exception as ex:
-            log.warning('InfluxDB insertion of datapoints failed')
+    try:
+        influxDbClient.write_points(points=points, database='wlanthermo', batch_size=5000, time_precision='n', protocol='line')
+        log.info('InfluxDB datapoints inserted')
+    except (InfluxDBClientError, InfluxDBServerError, requests.RequestException) as ex:
+        log.warning('InfluxDB insertion of datapoints failed')
+        if _DEBUG:
             log.debug(ex)
 
-def createDataPoints(message):
+def sendPointsUdp(udpTarget, points):
+    udpSocket, udpAddress = udpTarget
+    try:
+        udpSocket.sendto('\n'.join(points).encode('utf-8'), udpAddress)
+        log.info('InfluxDB datapoints sent via udp')
+    except OSError as ex:
+        log.warning('InfluxDB udp send of datapoints failed')
+        if _DEBUG:
+            log.debug(ex)
+
+def queuePoints(writeQueue, points):
+    try:
+        writeQueue.put_nowait(points)
+    except queue.Full:
+        # there is only one producer (the mqtt network thread, or main on shutdown), so dropping the oldest entry always makes room
+        writeQueue.get_nowait()
+        writeQueue.put_nowait(points)
+        log.warning('InfluxDB write queue full, dropped oldest datapoints')
+
+def influxDbWriter(influxDbClient, writeQueue):
+    stopping = False
+
+    while not stopping:
+        queuedPoints = writeQueue.get()
+        if queuedPoints is None:
+            break
+
+        points = list(queuedPoints)
+        flushDeadline = time.monotonic() + FLUSH_INTERVAL
+        while len(points) < FLUSH_BATCH_SIZE:
+            timeout = flushDeadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                queuedPoints = writeQueue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if queuedPoints is None:
+                stopping = True
+                break
+            points.extend(queuedPoints)
+
+        try:
+            addPointsToDatabase(influxDbClient, points)
+        except Exception:
+            # keep the writer alive, otherwise the queue fills up and every later write is dropped
+            log.exception('InfluxDB insertion of datapoints failed unexpectedly')
+
+def createPoints(message, getSystemTime, creators, pointsKind):
     points = []
 
     try:
-        timestampStr = getTimestampStr(int(message['system']['time']))
+        timestampStr = getTimestampStr(int(getSystemTime(message)))
 
-        createDataSystemPoints(points, timestampStr, message)
-        createDataChannelPoints(points, timestampStr, message)
-        createDataPitmasterPoints(points, timestampStr, message)
+        for createKindPoints in creators:
+            createKindPoints(points, timestampStr, message)
 
-        log.debug('Created data points from json payload')
-    except Exception as ex:
-        log.warning('Failed to create data points from json payload')
-        log.debug(ex)
+        if _DEBUG:
+            log.debug(f'Created {pointsKind} points from json payload')
+    except (KeyError, ValueError, TypeError) as ex:
+        log.warning(f'Failed to create {pointsKind} points from json payload')
+        if _DEBUG:
+            log.debug(ex)
 
     return points
 
-def createSettingsPoints(message):
-    points = []
+DATA_POINT_CREATORS = (createDataSystemPoints, createDataChannelPoints, createDataPitmasterPoints)
+SETTINGS_POINT_CREATORS = (createSettingsSystemPoints,)
 
-    try:
-        timestampStr = getTimestampStr(int(message['system']['time']))
+def getDataSystemTime(message):
+    return message.system['time']
 
-        createSettingsSystemPoints(points, timestampStr, message)
+def getSettingsSystemTime(message):
+    return message['system']['time']
 
-        log.debug('Created settings points from json payload')
-    except Exception as ex:
-        log.warning('Failed to create settings points from json payload')
-        log.debug(ex)
+def createDataPoints(message):
+    return createPoints(message, getDataSystemTime, DATA_POINT_CREATORS, 'data')
 
-    return points
+def createSettingsPoints(message):
+    return createPoints(message, getSettingsSystemTime, SETTINGS_POINT_CREATORS, 'settings')
 
-def mqtt_on_connect(client, globalScope, flags, rc):
+def mqtt_on_connect(client, context, flags, rc):
     if rc == 0:
         log.info('Connection to mqtt broker successfull')
-        client.subscribe('WLanThermo/+/status/settings')
-        client.subscribe('WLanThermo/+/status/data')
+        client.subscribe('WLanThermo/+/status/+')
         log.info('Subscribed to mqtt topics')
     else:
         log.error('Connection to mqtt broker failed rc={}'.format(rc))
 
-def mqtt_on_message(client, globalScope, msg):
-    decodedMessage = str(msg.payload.decode("utf-8","ignore"))
-    log.info('Received unhandled mqtt message')
-    log.debug(decodedMessage)
-
-def on_wlanthermo_data(client, globalScope, msg):
+def on_wlanthermo_data(client, context, msg):
+    writeQueue, wlanThermoHostname, udpTarget = context
     log.info('Received wlanthermo mqtt data message')
-    decodedMessage = str(msg.payload.decode("utf-8","ignore"))
-    log.debug(decodedMessage)
+    if _DEBUG:
+        log.debug(msg.payload.decode("utf-8","ignore"))
     try:
-        messageJson = json.loads(decodedMessage)
-        points = createDataPoints(messageJson)
-        addPointsToDatabase(globalScope.influxDbClient, points)
-        if globalScope.wlanThermoHostname:
-            log.info('Request settings object')
-            try:
-                client.publish('WLanThermo/{}/get/settings'.format(globalScope.wlanThermoHostname))
-            except Exception as ex:
-                log.warning('Failed to request settings object')
-                log.debug(ex)
-    except Exception as ex:
+        message = DATA_MESSAGE_DECODER.decode(msg.payload)
+    except msgspec.DecodeError as ex:
         log.warning('Failed to parse json payload')
-        log.debug(ex)
+        if _DEBUG:
+            log.debug(ex)
+        return
+
+    points = createDataPoints(message)
+    if points:
+        if udpTarget:
+            sendPointsUdp(udpTarget, points)
+        else:
+            queuePoints(writeQueue, points)
+
+    if wlanThermoHostname:
+        log.info('Request settings object')
+        try:
+            client.publish('WLanThermo/{}/get/settings'.format(wlanThermoHostname))
+        except ValueError as ex:
+            log.warning('Failed to request settings object')
+            if _DEBUG:
+                log.debug(ex)
 
-def on_wlanthermo_settings(client, globalScope, msg):
-    decodedMessage = str(msg.payload.decode("utf-8","ignore"))
+def on_wlanthermo_settings(client, context, msg):
+    writeQueue = context[0]
     log.info('Received wlanthermo mqtt settings message')
-    log.debug(decodedMessage)
+    if _DEBUG:
+        log.debug(msg.payload.decode("utf-8","ignore"))
     try:
-        messageJson = json.loads(decodedMessage)
+        messageJson = msgspec.json.decode(msg.payload)
         points = createSettingsPoints(messageJson)
-        addPointsToDatabase(globalScope.influxDbClient, points)
-    except Exception as ex:
+        if points:
+            queuePoints(writeQueue, points)
+    except msgspec.DecodeError as ex:
         log.warning('Failed to parse json payload')
-        log.debug(ex)
+        if _DEBUG:
+            log.debug(ex)
+
+STATUS_TOPIC_HANDLERS = {
+    'data': on_wlanthermo_data,
+    'settings': on_wlanthermo_settings
+}
+
+def mqtt_on_message(client, context, msg):
+    handler = STATUS_TOPIC_HANDLERS.get(msg.topic.rsplit('/', 1)[-1])
+    if handler:
+        try:
+            handler(client, context, msg)
+        except Exception:
+            # paho swallows callback exceptions without logging them, so unexpected errors are reported here
+            log.exception('Failed to handle wlanthermo mqtt message')
+        return
+
+    log.info('Received unhandled mqtt message')
+    if _DEBUG:
+        log.debug(msg.payload.decode("utf-8","ignore"))
 
 def main(argv):
+    global _DEBUG
     mqtt_client_name = "wlanThermoGrafanaBridge"
-    globalScope = GlobalScope()
+    writeQueue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
 
     parser = argparse.ArgumentParser(description='WlanThermoGrafanaBridge')
     parser.add_argument('--mqttHost', metavar='<mqtt hostname>', type=str, default='localhost', help='MQTT host')
@@ -175,6 +305,9 @@ def main(argv):
     parser.add_argument('--influxDbPort', metavar='<influxDB port>', type=int, default=8086, help='InfluxDB port')
     parser.add_argument('--influxDbUsername', metavar='<influxDB username>', type=str, default='', help='InfluxDB username')
     parser.add_argument('--influxDbPassword', metavar='<influxDB password>', type=str, default='', help='InfluxDB password')
+    parser.add_argument('--influxDbUdpPort', metavar='<influxDB udp port>', type=int, default=None, help='InfluxDB udp port (IPv4 or IPv6) for data points, settings are still written via http. '
+        'Data points go to the database configured for the InfluxDB udp listener, set it to wlanthermo '
+        'with the default nanosecond precision to keep data and settings in the same database')
     parser.add_argument('--influxDbName', metavar='<influxDB name>', type=str, default='wlanthermo', help='InfluxDB database name')
     parser.add_argument('--wlanThermoHostname', metavar='<wlanThermo hostname>', type=str, default=None, help='WlanThermo hostname')
     parser.add_argument('--logLevel', metavar='<log level>', type=str, choices=['debug', 'info', 'warning', 'error'], default='info', help='Set Log level')
@@ -196,29 +329,52 @@ def main(argv):
 
     logging.basicConfig(level=logLevels.get(args.logLevel, logging.INFO), filename=args.logFile)
 
-    globalScope.wlanThermoHostname = args.wlanThermoHostname
+    # hand records to a listener thread so log file writes do not block the mqtt network thread
+    rootLogger = logging.getLogger()
+    logQueue = queue.SimpleQueue()
+    logListener = logging.handlers.QueueListener(logQueue, *rootLogger.handlers, respect_handler_level=True)
+    rootLogger.handlers = [logging.handlers.QueueHandler(logQueue)]
+    logListener.start()
+    atexit.register(logListener.stop)
+    _DEBUG = log.isEnabledFor(logging.DEBUG)
+
+    udpTarget = None
+    if args.influxDbUdpPort:
+        try:
+            udpFamily, udpType, udpProto, _, udpAddress = socket.getaddrinfo(
+                args.influxDbHost, args.influxDbUdpPort, type=socket.SOCK_DGRAM)[0]
+            udpTarget = (socket.socket(udpFamily, udpType, udpProto), udpAddress)
+            # udp send errors are not reported back, so log where datagrams actually go (e.g. ::1 vs an IPv4-only listener)
+            log.info('Sending InfluxDB data points via udp to {}:{}'.format(udpAddress[0], udpAddress[1]))
+        except OSError as ex:
+            log.error('Failed to set up InfluxDB udp socket')
+            log.debug(ex)
+            exit(1)
+
+    # mqtt callback userdata, unpacked once per message: (write queue, wlanthermo hostname, udp socket and address)
+    context = (writeQueue, args.wlanThermoHostname, udpTarget)
 
     influxDbClient = InfluxDBClient(host=args.influxDbHost, port=args.influxDbPort,
-        username=args.influxDbUsername, password=args.influxDbPassword, database=args.influxDbName)
+        username=args.influxDbUsername, password=args.influxDbPassword, database=args.influxDbName,
+        gzip=True, pool_size=1, retries=3, timeout=5)
 
-    mqttClient = mqtt.Client(client_id=mqtt_client_name, clean_session=True, userdata=globalScope)
+    mqttClient = mqtt.Client(client_id=mqtt_client_name, clean_session=True, userdata=context)
     mqttClient.username_pw_set(args.mqttUsername, args.mqttPassword)
     mqttClient.on_connect = mqtt_on_connect
     mqttClient.on_message = mqtt_on_message
 
-    mqttClient.message_callback_add('WLanThermo/+/status/settings', on_wlanthermo_settings)
-    mqttClient.message_callback_add('WLanThermo/+/status/data', on_wlanthermo_data)
-
     try:
         log.info('Connect to InfluxDB {}:{}'.format(args.influxDbHost, args.influxDbPort))
         influxDbClient.create_database(args.influxDbName)
-        globalScope.influxDbClient = influxDbClient
         log.info('Connect to InfluxDB successful')
     except Exception as ex:
         log.error('Connection to InfluxDB failed')
         log.debug(ex)
         exit(1)
 
+    writerThread = threading.Thread(target=influxDbWriter, args=(influxDbClient, writeQueue), daemon=True)
+    writerThread.start()
+
     try:
         log.info('Connect to mqtt broker {}:{}'.format(args.mqttHost, args.mqttPort))
         mqttClient.connect(args.mqttHost, args.mqttPort)
@@ -227,7 +383,17 @@ def main(argv):
         log.debug(ex)
         exit(1)
 
-    mqttClient.loop_forever()
+    try:
+        mqttClient.loop_forever()
+    except KeyboardInterrupt:
+        log.info('Shutting down')
+    finally:
+        mqttClient.disconnect()
+        queuePoints(writeQueue, None)
+        # the writer flushes whatever is still queued, but an unreachable influxdb must not block shutdown
+        writerThread.join(timeout=WRITER_SHUTDOWN_TIMEOUT)
+        if writerThread.is_alive():
+            log.warning('InfluxDB writer did not finish within {}s, remaining datapoints are dropped'.format(WRITER_SHUTDOWN_TIMEOUT))
 
 if __name__ == "__main__":
     main(sys.argv[1:])
\ No newline at end of file